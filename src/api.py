@@ -1,15 +1,83 @@
 """Description of your app."""
+import hashlib
+import json
 import logging
-from typing import Optional, Type, List
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Type, List, Dict, Tuple
 
-from steamship import EmbeddingIndex, File, SteamshipError
-from steamship.invocable import Config, create_handler, post, PackageService
+from steamship import EmbeddingIndex, File, Steamship, SteamshipError, Tag
+from steamship.data.embeddings import QueryResult
+from steamship.invocable import Config, create_handler, get, post, PackageService
 
-from model import OiFeed, OiIntent, OiAnswer, OiTrigger, OiQuestion, OiResponse
+from bundle import OiBundle, compile_bundle, download_bundle, fetch_trigger_vectors
+from model import OiFeed, OiIntent, OiAnswer, OiTrigger, OiQuestion, OiResponse, OiMatch, GptPrompt, OI_PARTITION
+from singleflight import SharedFlight
+
+BUNDLE_MIME_TYPE = "application/vnd.oi.bundle"
+INDEX_HANDLE = "prompt-index"
+# Most indices a single query may search; beyond this, callers must select partitions.
+MAX_PARTITION_FANOUT = 8
+PARTITIONS_TTL_SECONDS = 60
+# How long a query's match is shared with other workers, and so how stale an answer may be after learning.
+QUERY_FLIGHT_TTL_SECONDS = 10
+SEARCH_THREADS = 8
+
+# Shared by every package instance in the process, so that concurrent requests coalesce; matches are also
+# shared with the workspace's other workers for QUERY_FLIGHT_TTL_SECONDS.
+QUERY_FLIGHTS = SharedFlight("QueryFlights", ttl_seconds=QUERY_FLIGHT_TTL_SECONDS)
+
+# Loaded bundles, keyed by local path. A package instance is built per invocation, so this is process-wide.
+BUNDLES: Dict[str, OiBundle] = {}
+BUNDLES_LOCK = threading.Lock()
+
+# Embedding indices keyed by (workspace ID, handle), known partitions keyed by workspace ID as
+# (loaded at, partition name -> index handle), and when unknown partition names were last looked up, keyed by
+# (workspace ID, name). All are process-wide for the same reason. Cached indices hold no client: each
+# invocation binds its own, so one caller's credentials are never reused for another.
+INDICES: Dict[Tuple[str, str], EmbeddingIndex] = {}
+KNOWN_PARTITIONS: Dict[str, Tuple[float, Dict[str, str]]] = {}
+MISSING_PARTITIONS: Dict[Tuple[str, str], float] = {}
+PARTITIONS_LOCK = threading.Lock()
+SEARCH_EXECUTOR = ThreadPoolExecutor(max_workers=SEARCH_THREADS)
+
+def _score(item: QueryResult) -> float:
+    if item.score is not None:
+        return item.score
+    return item.value.score if item.value and item.value.score is not None else 0
+
+def partition_index_handle(partition: str) -> str:
+    """Return the index handle for a partition name.
+
+    The readable prefix is lossy ("Office B" and "office_b" share it); the hash keeps distinct names apart.
+    """
+    slug = re.sub("[^a-z0-9]+", "-", partition.lower()).strip("-")[:32]
+    digest = hashlib.sha256(partition.encode("utf-8")).hexdigest()[:12]
+    return f"{INDEX_HANDLE}-{slug}-{digest}" if slug else f"{INDEX_HANDLE}-{digest}"
+
+def load_bundle(client: Steamship, config: "OiPackageConfig") -> Optional[OiBundle]:
+    """Return the configured bundle, downloading and loading it at most once per process."""
+    path = config.bundle_path
+    if path is None and config.bundle_file_id is not None:
+        path = download_bundle(client, config.bundle_file_id)
+    if path is None:
+        return None
+    with BUNDLES_LOCK:
+        if path not in BUNDLES:
+            BUNDLES[path] = OiBundle.load(path)
+        return BUNDLES[path]
 
 class OiPackageConfig(Config):
     openai_api_key: Optional[str] = None
 
+    # Local path of a compiled bundle (see `export_bundle`) to load at startup
+    bundle_path: Optional[str] = None
+
+    # File ID of a bundle returned by `export_bundle`, downloaded once per worker if `bundle_path` is not set
+    bundle_file_id: Optional[str] = None
+
 class OiPackage(PackageService):
     """Example steamship Package."""
 
@@ -21,68 +89,247 @@ class OiPackage(PackageService):
             "model": "text-similarity-davinci-001",
             "dimensionality": 12288
         })
-        self.index = EmbeddingIndex.create(
-            client=self.client,
-            handle="prompt-index",
-            plugin_instance=self.embedder.handle,
-            fetch_if_exists=True
-        )
+        self.index = self.get_index(INDEX_HANDLE)
+        self.bundle: Optional[OiBundle] = load_bundle(self.client, self.config)
 
     def config_cls(self) -> Type[Config]:
         return OiPackageConfig
 
+    def get_index(self, handle: str) -> EmbeddingIndex:
+        """Return the embedding index with `handle`, bound to this invocation's client.
+
+        The index is created or fetched at most once per process.
+        """
+        key = (self.client.config.workspace_id, handle)
+        with PARTITIONS_LOCK:
+            index = INDICES.get(key)
+        if index is None:
+            index = EmbeddingIndex.create(
+                client=self.client,
+                handle=handle,
+                plugin_instance=self.embedder.handle,
+                fetch_if_exists=True
+            )
+            with PARTITIONS_LOCK:
+                index = INDICES.setdefault(key, index.copy(update={"client": None}))
+        return index.copy(update={"client": self.client})
+
+    def known_partitions(self, refresh: bool = False) -> Dict[str, str]:
+        """Return the map of learned partition names to their index handles.
+
+        Each partition is recorded as its own file tag, so concurrent registrations cannot overwrite one another.
+        The map is cached per process for `PARTITIONS_TTL_SECONDS`.
+        """
+        workspace_id = self.client.config.workspace_id
+        with PARTITIONS_LOCK:
+            cached = KNOWN_PARTITIONS.get(workspace_id)
+        if not refresh and cached is not None and time.monotonic() - cached[0] < PARTITIONS_TTL_SECONDS:
+            return cached[1]
+
+        tags = Tag.query(self.client, f'filetag and kind "{OI_PARTITION}"').tags or []
+        known = {tag.name: tag.value["handle"] for tag in tags if tag.value and tag.value.get("handle")}
+        with PARTITIONS_LOCK:
+            KNOWN_PARTITIONS[workspace_id] = (time.monotonic(), known)
+        return known
+
+    def index_for(
+            self,
+            partition: Optional[str] = None,
+            register: bool = False,
+            shared: bool = False
+    ) -> Optional[EmbeddingIndex]:
+        """Return the embedding index for a partition.
+
+        Passing no partition returns the shared, unpartitioned index. An unknown partition returns None,
+        unless `register` is set, in which case it is recorded and its index created. Registering with `shared`
+        records the partition as a name for the shared index instead, for feeds learned before partitioning.
+
+        Unknown names are remembered for `PARTITIONS_TTL_SECONDS`, so repeated lookups do not each refresh the map.
+        """
+        if partition is None:
+            return self.index
+        handle = self.known_partitions().get(partition)
+        if handle is None:
+            key = (self.client.config.workspace_id, partition)
+            with PARTITIONS_LOCK:
+                missed_at = MISSING_PARTITIONS.get(key)
+            if register or missed_at is None or time.monotonic() - missed_at >= PARTITIONS_TTL_SECONDS:
+                # Another worker may have learned it since the cache was filled.
+                handle = self.known_partitions(refresh=True).get(partition)
+            if handle is None and not register:
+                with PARTITIONS_LOCK:
+                    MISSING_PARTITIONS[key] = time.monotonic()
+                return None
+            if handle is None:
+                handle = INDEX_HANDLE if shared else partition_index_handle(partition)
+                File.create(self.client, tags=[Tag.CreateRequest(kind=OI_PARTITION, name=partition, value={"handle": handle})])
+                self.known_partitions(refresh=True)
+            with PARTITIONS_LOCK:
+                MISSING_PARTITIONS.pop(key, None)
+        return self.get_index(handle)
+
+    def indices_for(self, partitions: Optional[List[str]] = None) -> List[EmbeddingIndex]:
+        """Return the indices to search for a partition selector.
+
+        A selector of None searches the unpartitioned index and every known partition, so it is refused once
+        that is more than `MAX_PARTITION_FANOUT` indices. Unknown partitions are skipped rather than created.
+        """
+        if partitions is None:
+            handles = {INDEX_HANDLE} | set(self.known_partitions().values())
+            if len(handles) > MAX_PARTITION_FANOUT:
+                raise SteamshipError(
+                    message=f"This workspace has {len(handles)} partitions; select at most {MAX_PARTITION_FANOUT} with `partitions`."
+                )
+            return [self.index] + [self.get_index(handle) for handle in sorted(handles - {INDEX_HANDLE})]
+
+        indices = []
+        for partition in partitions:
+            index = self.index_for(partition)
+            if index is None:
+                logging.info(f"Skipping search of unknown partition: {partition}")
+            elif index.id not in [i.id for i in indices]:
+                indices.append(index)
+        if len(indices) > MAX_PARTITION_FANOUT:
+            raise SteamshipError(message=f"Select at most {MAX_PARTITION_FANOUT} partitions; got {len(indices)}.")
+        return indices
+
+    def search(self, question: OiQuestion, k: int = 1) -> List[QueryResult]:
+        """Search the partitions selected by the question, merging the top `k` results across them."""
+        indices = self.indices_for(question.partitions)
+
+        def search_one(index: EmbeddingIndex) -> List[QueryResult]:
+            search_task = index.search(question.text, k=k, include_metadata=True)
+            search_task.wait()
+            return search_task.output.items or []
+
+        if not indices:
+            return []
+        if len(indices) == 1:
+            return search_one(indices[0])[:k]
+
+        items = []
+        for shard_items in SEARCH_EXECUTOR.map(search_one, indices):
+            items.extend(shard_items)
+        items.sort(key=_score, reverse=True)
+        return items[:k]
+
     @post("learn_intent")
-    def learn_intent(self, intent: OiIntent = None) -> OiIntent:
-        """Learn an intent."""
+    def learn_intent(self, intent: OiIntent = None, partition: Optional[str] = None) -> OiIntent:
+        """Learn an intent, optionally into a partition."""
         if not intent:
             raise SteamshipError(message="Provided `intent` was None")
         if isinstance(intent, dict):
             intent = OiIntent.parse_obj(intent)
-        return intent.save(self.client, self.index)
+        return intent.save(self.client, self.index_for(partition, register=True))
 
     @post("learn_feed")
     def learn_feed(self, feed: OiFeed = None) -> OiFeed:
-        """Learn a whole feed of intents."""
+        """Learn a whole feed of intents into its partition.
+
+        A feed without a declared partition is partitioned by its handle. If such a feed already has triggers
+        in the shared index, having been learned before partitioning, its handle is recorded as a name for
+        the shared index instead, so that it can still be selected.
+        """
+        if isinstance(feed, dict):
+            feed = OiFeed.parse_obj(feed)
+        if not feed:
+            raise SteamshipError(message="Provided `feed` was None")
+        legacy = feed.partition is None and any(
+            trigger.embedding_id is not None for intent in feed.intents or [] for trigger in intent.triggers or []
+        )
+        return feed.save(self.client, self.index_for(feed.partition_key, register=True, shared=legacy))
+
+    @post("export_bundle")
+    def export_bundle(self, feed: OiFeed = None) -> File:
+        """Compile a learned feed into a bundle file that workers can load at startup."""
         if isinstance(feed, dict):
             feed = OiFeed.parse_obj(feed)
         if not feed:
             raise SteamshipError(message="Provided `feed` was None")
-        return feed.save(self.client, self.index)
+        index = self.index_for(feed.partition_key)
+        if index is None:
+            raise SteamshipError(message=f"Unable to bundle feed {feed.handle} because partition {feed.partition_key} has not been learned.")
+        vectors = fetch_trigger_vectors(index, feed)
+        return File.create(self.client, content=compile_bundle(feed, vectors), mime_type=BUNDLE_MIME_TYPE)
 
     @post("query")
     def query(self, question: Optional[OiQuestion] = None) -> OiAnswer:
         """Query Oi with a question."""
         if isinstance(question, dict):
             question = OiQuestion.parse_obj(question)
-        search_task = self.index.search(question.text, include_metadata=True)
-        search_task.wait()
 
-        if not search_task.output.items:
+        # The bundle only answers for its own partition.
+        bundle = self.bundle
+        if bundle is not None and question.partitions is not None and bundle.partition not in question.partitions:
+            bundle = None
+
+        # Identical questions share one search-and-fetch across workers; each still completes its own response.
+        key = [
+            bundle.path if bundle else None,
+            # Only case and whitespace are ignored: punctuation can change the match ("C++?" vs "C#").
+            " ".join(question.text.lower().split()),
+            None if question.context is None else sorted(set(question.context)),
+            None if question.partitions is None else sorted(set(question.partitions))
+        ]
+        match = QUERY_FLIGHTS.do(
+            self.client,
+            key,
+            lambda: self.match(question, bundle),
+            dump=lambda m: json.loads(m.json(by_alias=True)),
+            load=OiMatch.parse_obj
+        )
+        if match.response is None:
             return OiAnswer(top_response=None)
-        else:
+
+        # Now we have to generate the return response.
+        # 1. Fixed response
+        # 2. Shuffled from a list of options
+        # Along with possible prompt-based completion
+        ret_response = match.response.complete_response(
+            client=self.client,
+            question=question,
+            intent=match.intent,
+            openai_api_key=self.config.openai_api_key,
+            prompts=match.prompts
+        )
+
+        return OiAnswer(top_response=ret_response)
+
+    def match(self, question: OiQuestion, bundle: Optional[OiBundle] = None) -> OiMatch:
+        """Find the intent and response matching a question, along with the prompts needed to complete it."""
+        # A trigger that is normalized-identical to the question needs no search.
+        matched_intent = bundle.match_trigger(question.text) if bundle else None
+
+        if matched_intent is None:
+            items = self.search(question)
+
+            if not items:
+                return OiMatch()
+
             # Get return the item
-            top = search_task.output.items[0].value
+            top = items[0].value
             file_id = top.external_id
 
-            # Get the file and turn it into an intent
-            file = File.get(self.client, _id=file_id)
-            matched_intent = OiIntent.from_steamship_file(file)
+            # Prefer the loaded bundle; otherwise get the file and turn it into an intent
+            matched_intent = bundle.intent_for_file(file_id) if bundle else None
+            if matched_intent is None:
+                file = File.get(self.client, _id=file_id)
+                matched_intent = OiIntent.from_steamship_file(file)
 
-            # Find the best matching response from the context adn return it
-            response = matched_intent.top_response(question.context)
+        # Find the best matching response from the context adn return it
+        response = matched_intent.top_response(question.context)
 
-            # Now we have to generate the return response.
-            # 1. Fixed response
-            # 2. Shuffled from a list of options
-            # Along with possible prompt-based completion
-            ret_response = response.complete_response(
-                client=self.client,
-                question=question,
-                intent=matched_intent,
-                openai_api_key=self.config.openai_api_key
-            )
+        prompts = dict(bundle.prompts) if bundle else {}
+        if response is not None and response.prompt_handle is not None and response.prompt_handle not in prompts:
+            prompt = GptPrompt.get_from_handle(self.client, response.prompt_handle)
+            if prompt is not None:
+                prompts[prompt.handle] = prompt
 
-            return OiAnswer(top_response=ret_response)
+        return OiMatch(intent=matched_intent, response=response, prompts=prompts)
 
+    @get("metrics")
+    def metrics(self) -> dict:
+        """Report query coalescing counts summed over the workspace's workers, and this worker's in-process counts."""
+        return {"queries": QUERY_FLIGHTS.stats(self.client), "worker": QUERY_FLIGHTS.local.stats()}
 
 handler = create_handler(OiPackage)
@@ -0,0 +1,194 @@
+"""Compiled knowledge bundles for OI feeds.
+
+A bundle packs everything a worker needs to answer from a learned feed into a single file:
+
+    [header][json section][padding][vector block]
+
+The header is a fixed-size little-endian struct (see `HEADER`). The JSON section holds the intents
+(with their responses), the normalized trigger map, and the prompt templates. The vector block is a
+contiguous, row-major array of float32 trigger embeddings, one row per entry in the trigger map.
+
+Bundles are exported to a Steamship file; workers `download_bundle` it once and `OiBundle.load` it at startup.
+Loading parses the JSON section, which is what `query` reads: intents and prompts by file ID, and exact trigger
+matches. Nothing reads the vector block yet; it is validated on load and carried for a future local search.
+"""
+import json
+import logging
+import mmap
+import os
+import struct
+import tempfile
+from array import array
+from typing import Optional, List, Dict
+
+from steamship import EmbeddingIndex, File, Steamship, SteamshipError
+
+from model import OiFeed, OiIntent, GptPrompt, normalize_trigger_text
+
+MAGIC = b"OIBUNDLE"
+VERSION = 1
+
+# magic, version, dimensionality, json section length, vector count
+HEADER = struct.Struct("<8sIIQQ")
+ALIGNMENT = 8
+FLOAT_SIZE = 4
+
+
+def _padding(length: int) -> int:
+    return (ALIGNMENT - length % ALIGNMENT) % ALIGNMENT
+
+
+def fetch_trigger_vectors(index: EmbeddingIndex, feed: OiFeed) -> Dict[str, List[float]]:
+    """Fetch the embedding vector of every trigger in a learned feed, keyed by `embedding_id`.
+
+    Items are listed per intent file, so the cost scales with the feed rather than the whole index.
+    Triggers learned before items carried their intent's file ID will not be found; re-learn those intents.
+    """
+    vectors = {}
+    for intent in feed.intents or []:
+        if intent.file_id is None:
+            raise SteamshipError(message=f"Unable to bundle intent handle={intent.handle} because it has not been learned.")
+        wanted = {trigger.embedding_id for trigger in intent.triggers or []}
+        res = index.list_items(file_id=intent.file_id)
+        for item in res.items or []:
+            if item.id in wanted and item.embedding:
+                vectors[item.id] = item.embedding
+    return vectors
+
+
+def compile_bundle(feed: OiFeed, vectors: Dict[str, List[float]]) -> bytes:
+    """Compile a learned feed and its trigger vectors into bundle bytes."""
+    intents = []
+    triggers = {}
+    block = array("f")
+    dimensionality = 0
+
+    for intent in feed.intents or []:
+        if intent.file_id is None:
+            raise SteamshipError(message=f"Unable to bundle intent handle={intent.handle} because it has not been learned.")
+        intents.append(intent.dict(by_alias=True, exclude={"triggers", "report"}))
+
+        for trigger in intent.triggers or []:
+            key = normalize_trigger_text(trigger.text)
+            if key in triggers:
+                logging.info(f"Skipping duplicate bundle trigger: {trigger.text}")
+                continue
+            vector = vectors.get(trigger.embedding_id)
+            if vector is None:
+                raise SteamshipError(message=f"Unable to bundle trigger '{trigger.text}' because no vector was found for embedding {trigger.embedding_id}.")
+            if not dimensionality:
+                dimensionality = len(vector)
+            elif len(vector) != dimensionality:
+                raise SteamshipError(message=f"Trigger '{trigger.text}' has dimensionality {len(vector)}; expected {dimensionality}.")
+            triggers[key] = {
+                "intent": intent.handle,
+                "fileId": intent.file_id,
+                "embeddingId": trigger.embedding_id,
+                "row": len(triggers)
+            }
+            block.extend(vector)
+
+    section = json.dumps({
+        "handle": feed.handle,
+        "partition": feed.partition_key,
+        "intents": intents,
+        "triggers": triggers,
+        "prompts": [prompt.dict(by_alias=True) for prompt in feed.prompts or [] if prompt is not None]
+    }).encode("utf-8")
+
+    if block.itemsize != FLOAT_SIZE:
+        raise SteamshipError(message="Bundles require a platform with 4-byte floats.")
+    # The vector block is always little-endian on disk.
+    if struct.pack("=I", 1) != struct.pack("<I", 1):
+        block.byteswap()
+
+    header = HEADER.pack(MAGIC, VERSION, dimensionality, len(section), len(triggers))
+    return b"".join([
+        header,
+        section,
+        b"\0" * _padding(HEADER.size + len(section)),
+        block.tobytes()
+    ])
+
+
+def download_bundle(client: Steamship, file_id: str) -> str:
+    """Download an exported bundle to local disk, unless already present, and return its path."""
+    path = os.path.join(tempfile.gettempdir(), f"oi-bundle-{file_id}.oi")
+    if not os.path.exists(path):
+        logging.info(f"Downloading OI bundle {file_id} to {path}")
+        content = File.get(client, _id=file_id).raw()
+        partial = f"{path}.{os.getpid()}.partial"
+        with open(partial, "wb") as f:
+            f.write(content)
+        os.replace(partial, path)
+    return path
+
+
+class OiBundle:
+    """A compiled feed, loaded for read-only lookups."""
+
+    def __init__(self, dimensionality: int, section: Dict):
+        self.path: Optional[str] = None
+        self.dimensionality = dimensionality
+        self.handle: str = section.get("handle")
+        self.partition: Optional[str] = section.get("partition")
+        self.triggers: Dict[str, Dict] = section.get("triggers") or {}
+
+        self.intents: Dict[str, OiIntent] = {}
+        self.intents_by_file_id: Dict[str, OiIntent] = {}
+        for obj in section.get("intents") or []:
+            intent = OiIntent.parse_obj(obj)
+            self.intents[intent.handle] = intent
+            self.intents_by_file_id[intent.file_id] = intent
+
+        self.prompts: Dict[str, GptPrompt] = {}
+        for obj in section.get("prompts") or []:
+            prompt = GptPrompt.parse_obj(obj)
+            self.prompts[prompt.handle] = prompt
+
+    @staticmethod
+    def from_buffer(buffer) -> "OiBundle":
+        view = memoryview(buffer)
+        if len(view) < HEADER.size:
+            raise SteamshipError(message="Bundle is truncated.")
+        magic, version, dimensionality, section_length, count = HEADER.unpack_from(view, 0)
+        if magic != MAGIC:
+            raise SteamshipError(message="File is not an OI bundle.")
+        if version != VERSION:
+            raise SteamshipError(message=f"Unsupported OI bundle version {version}; expected {VERSION}.")
+
+        section_end = HEADER.size + section_length
+        offset = section_end + _padding(section_end)
+        end = offset + count * dimensionality * FLOAT_SIZE
+        if len(view) < end:
+            raise SteamshipError(message="Bundle is truncated.")
+        section = json.loads(bytes(view[HEADER.size:section_end]).decode("utf-8"))
+        view.release()
+        return OiBundle(dimensionality, section)
+
+    @staticmethod
+    def load(path: str) -> "OiBundle":
+        """Load the bundle at `path`.
+
+        The file is memory-mapped while it is parsed, so the vector block is never read into memory.
+        """
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            logging.info(f"Loading OI bundle {path} ({len(buffer)} bytes)")
+            bundle = OiBundle.from_buffer(buffer)
+        bundle.path = path
+        return bundle
+
+    @staticmethod
+    def write(path: str, feed: OiFeed, vectors: Dict[str, List[float]]):
+        with open(path, "wb") as f:
+            f.write(compile_bundle(feed, vectors))
+
+    def intent_for_file(self, file_id: str) -> Optional[OiIntent]:
+        return self.intents_by_file_id.get(file_id)
+
+    def match_trigger(self, text: str) -> Optional[OiIntent]:
+        """Return the intent whose trigger is normalized-identical to `text`, if any."""
+        entry = self.triggers.get(normalize_trigger_text(text))
+        if entry is None:
+            return None
+        return self.intents_by_file_id.get(entry["fileId"])
@@ -1,11 +1,13 @@
 """Data model for OI"""
+import hashlib
 import logging
 from enum import Enum
 from random import choice
-from typing import Optional, List
+from typing import Optional, List, Dict, Tuple
 
 from steamship import File, Block, Tag, EmbeddingIndex, Steamship, SteamshipError
 from steamship.base.model import CamelModel
+from steamship.data.embeddings import EmbeddedItem
 from steamship.utils.kv_store import KeyValueStore
 
 from openai import complete
@@ -13,6 +15,21 @@ from openai import complete
 OI_RESPONSE = "oi-response"
 OI_CONTEXT = "oi-context"
 OI_INTENT = "oi-intent"
+OI_PARTITION = "oi-partition"
+OI_TRIGGER = "oi-trigger"
+
+# Most trigger names looked up by one tag query
+TRIGGER_QUERY_BATCH = 25
+
+
+def normalize_trigger_text(text: str) -> str:
+    """Normalize trigger text so that trivially different phrasings compare equal.
+
+    Lowercases, collapses whitespace, and drops trailing sentence punctuation (?!.). Other punctuation is
+    significant ("C++" and "C#" stay distinct), and text made only of punctuation is kept whole.
+    """
+    collapsed = " ".join((text or "").lower().split())
+    return collapsed.rstrip("?!. ") or collapsed
 
 class OiResponseType(str, Enum):
     FIXED = "fixed"
@@ -43,6 +60,7 @@ class GptPrompt(CamelModel):
             "temperature": self.temperature,
             "stop": self.stop
         })
+        return self
 
     @staticmethod
     def get_store(client: Steamship) -> KeyValueStore:
@@ -177,12 +195,15 @@ class OiResponse(CamelModel):
             client: Steamship,
             question: "OiQuestion",
             intent: "OiIntent",
-            openai_api_key: str
+            openai_api_key: str,
+            prompts: Optional[Dict[str, GptPrompt]] = None
     ):
         """Generate the complete response.
 
         A response can be fixed (e.g. `response.text`).
         But it can also be something generated, or one of a set of responses,
+
+        If `prompts` is provided, it is consulted for the completion prompt before the remote prompt store.
         """
 
         # First, either select the fixed output text or a shuffled one.
@@ -196,7 +217,9 @@ class OiResponse(CamelModel):
 
         # Next, if we should pass it through a prompt, do it.
         if self.prompt_handle is not None:
-            prompt = GptPrompt.get_from_handle(client, self.prompt_handle)
+            prompt = (prompts or {}).get(self.prompt_handle)
+            if prompt is None:
+                prompt = GptPrompt.get_from_handle(client, self.prompt_handle)
             if prompt is None:
                 raise SteamshipError(message=f"Unable to locate completion prompt: {self.prompt_handle}")
             output_text = prompt.complete_response(
@@ -216,6 +239,114 @@ class OiTrigger(CamelModel):
     embedding_id: Optional[str] = None
 
 
+class OiIngestReport(CamelModel):
+    # Triggers newly inserted into the index and embedded
+    embedded: int = 0
+
+    # Triggers that share an item already pointing at the same intent file (repeated within it, or saved before).
+    # These are the only duplicates that save storage.
+    duplicates_within_intent: int = 0
+
+    # Triggers whose vector was copied from another intent learned in the same save
+    duplicates_within_feed: int = 0
+
+    # Triggers whose vector was copied from another intent learned by an earlier save
+    duplicates_across_feeds: int = 0
+
+    # Triggers whose vector was copied from an earlier file of the same intent
+    duplicates_from_earlier_versions: int = 0
+
+    # New items holding a copied vector: each saves an embedding call, but is stored like any other item
+    vectors_copied: int = 0
+
+
+class TriggerRegistry:
+    """Content-addressed record of the index items that embed each normalized trigger text.
+
+    Items are recorded as tags named by a hash of the normalized text, one file of tags per intent save, so writers
+    never rewrite shared state. Lookups are batched: one tag query per `TRIGGER_QUERY_BATCH` distinct texts.
+    """
+
+    def __init__(self, client: Steamship, index: EmbeddingIndex):
+        self.client = client
+        self.index = index
+        self.report = OiIngestReport()
+        self._saved: Dict[str, List[Dict]] = {}
+        self._found: Dict[str, List[Dict]] = {}
+        self._vectors: Dict[Tuple[str, str], Dict[str, List[float]]] = {}
+
+    @staticmethod
+    def key(text: str) -> str:
+        return hashlib.sha256(normalize_trigger_text(text).encode("utf-8")).hexdigest()
+
+    def load(self, texts: List[str]):
+        """Look up the entries recorded by earlier saves for every text not looked up yet."""
+        keys = sorted({self.key(text) for text in texts} - set(self._found))
+        for start in range(0, len(keys), TRIGGER_QUERY_BATCH):
+            batch = keys[start:start + TRIGGER_QUERY_BATCH]
+            names = " or ".join(f'name "{key}"' for key in batch)
+            tags = Tag.query(self.client, f'filetag and kind "{OI_TRIGGER}" and ({names})').tags or []
+            for key in batch:
+                self._found[key] = []
+            for tag in tags:
+                if tag.value and tag.name in self._found:
+                    self._found[tag.name].append(tag.value)
+
+    def entries(self, key: str) -> List[Dict]:
+        """Entries recorded during this save come first, then those found by `load`."""
+        return self._saved.get(key, []) + self._found.get(key, [])
+
+    def vector(self, entry: Dict) -> Optional[List[float]]:
+        index_id = entry.get("indexId")
+        file_id = entry.get("fileId")
+        if (index_id, file_id) not in self._vectors:
+            index = EmbeddingIndex(client=self.client, id=index_id)
+            res = index.list_items(file_id=file_id)
+            self._vectors[(index_id, file_id)] = {item.id: item.embedding for item in res.items or [] if item.embedding}
+        return self._vectors[(index_id, file_id)].get(entry.get("embeddingId"))
+
+    def resolve(self, trigger: OiTrigger, intent_handle: str, file_id: str) -> Tuple[Optional[str], Optional[List[float]]]:
+        """Find an earlier embedding of `trigger`, counting the duplicate.
+
+        Returns the ID of an item to reuse, if one in this index already points at `file_id`. Otherwise returns a
+        vector to copy into a new item for `file_id`, so that the trigger still resolves to this intent without
+        being re-embedded; earlier versions of the same intent are preferred. Returns (None, None) if the trigger
+        must be embedded.
+        """
+        entries = self.entries(self.key(trigger.text))
+        for entry in entries:
+            if entry.get("fileId") == file_id and entry.get("indexId") == self.index.id:
+                self.report.duplicates_within_intent += 1
+                return entry.get("embeddingId"), None
+
+        same_intent = [entry for entry in entries if entry.get("intent") == intent_handle]
+        for entry in same_intent + [entry for entry in entries if entry.get("intent") != intent_handle]:
+            vector = self.vector(entry)
+            if vector is None:
+                continue
+            if entry.get("intent") == intent_handle:
+                self.report.duplicates_from_earlier_versions += 1
+            elif entry.get("saved"):
+                self.report.duplicates_within_feed += 1
+            else:
+                self.report.duplicates_across_feeds += 1
+            self.report.vectors_copied += 1
+            return None, vector
+
+        return None, None
+
+    def register(self, triggers: List[OiTrigger], intent_handle: str, file_id: str):
+        """Record newly inserted items, all in one request."""
+        tags = []
+        for trigger in triggers:
+            key = self.key(trigger.text)
+            value = {"embeddingId": trigger.embedding_id, "intent": intent_handle, "fileId": file_id, "indexId": self.index.id}
+            tags.append(Tag.CreateRequest(kind=OI_TRIGGER, name=key, value=value))
+            self._saved.setdefault(key, []).append(dict(value, saved=True))
+        # Tags go in with a file rather than through Tag.create, which in steamship 2.2.0 json.dumps dict values.
+        File.create(self.client, tags=tags)
+
+
 class OiIntent(CamelModel):
     # An intent should probably have a name
     handle: str
@@ -229,37 +360,96 @@ class OiIntent(CamelModel):
     # The file ID to associate it with
     file_id: str = None
 
-    def add_to_index(self, index: EmbeddingIndex, file_id: str) -> List[OiTrigger]:
-        """Add all the triggers to the embedding index, associated with the file ID containing the results."""
+    # Trigger deduplication counts from the last save, when saved on its own
+    report: Optional[OiIngestReport] = None
+
+    def add_to_index(self, index: EmbeddingIndex, file_id: str, registry: Optional[TriggerRegistry] = None) -> List[OiTrigger]:
+        """Add all the triggers to the embedding index, associated with the file ID containing the results.
+
+        Normalized-identical triggers within the intent share one item. If a `registry` is provided, triggers whose
+        normalized text was already embedded are not embedded again: an item already pointing at `file_id` is
+        reused, and otherwise the earlier vector is copied into a new item.
+        """
         ret = []
-        new_additions = []
+        pending: Dict[str, Tuple[EmbeddedItem, List[OiTrigger]]] = {}
         if self.triggers is None:
             raise SteamshipError(message=f"Unable to learn intent handle={self.handle} because no triggers were found.")
 
+        if registry:
+            registry.load([trigger.text for trigger in self.triggers if trigger.embedding_id is None])
+
         for trigger in self.triggers or []:
+            ret.append(trigger)
             if trigger.embedding_id is not None:
                 logging.info(f"Skipping index embed of trigger: {trigger.embedding_id} / {trigger.text}")
-                ret.append(trigger)
+                continue
+
+            text = normalize_trigger_text(trigger.text)
+            if text in pending:
+                logging.info(f"Sharing index embed of repeated trigger: {trigger.text}")
+                pending[text][1].append(trigger)
+                if registry:
+                    registry.report.duplicates_within_intent += 1
+                continue
+
+            embedding_id, vector = registry.resolve(trigger, self.handle, file_id) if registry else (None, None)
+            if embedding_id is not None:
+                logging.info(f"Reusing index embed of duplicate trigger: {embedding_id} / {trigger.text}")
+                trigger.embedding_id = embedding_id
+                continue
+
+            if vector is not None:
+                logging.info(f"Copying index embed of duplicate trigger: {trigger.text}")
             else:
                 logging.info(f"Adding index embed of trigger: {trigger.text}")
-                res = index.insert(trigger.text, external_id=file_id)
-                item = res.item_ids[0]
-                trigger.embedding_id = item.id
-                ret.append(trigger)
-                new_additions.append(trigger)
-
-        if len(new_additions):
-            logging.info(f"Added {len(new_additions)} new additions so embedding.")
-            embed_task = index.embed()
-            embed_task.wait()
-
-            logging.info(f"Added {len(new_additions)} new additions so snapshotting.")
-            index.create_snapshot()
-        else:
-            logging.info(f"Did not add any new additions; neither embedding nor snapshotting.")
+            # Items carry the intent's file ID so that `list_items(file_id=...)` can find them again.
+            item = EmbeddedItem(value=trigger.text, external_id=file_id, file_id=file_id, embedding=vector)
+            pending[text] = (item, [trigger])
 
+        if not pending:
+            logging.info(f"Did not add any new additions; neither embedding nor snapshotting.")
+            return ret
+
+        res = index.insert_many([item for item, _ in pending.values()])
+        for (item, triggers), item_id in zip(pending.values(), res.item_ids):
+            for trigger in triggers:
+                trigger.embedding_id = item_id.id
+        copies = {triggers[0].embedding_id: item.embedding for item, triggers in pending.values() if item.embedding}
+
+        # Copied items are only searchable once the index has embedded them too.
+        logging.info(f"Added {len(pending) - len(copies)} new additions and {len(copies)} copies so embedding.")
+        embed_task = index.embed()
+        embed_task.wait()
+
+        if copies:
+            self.check_copies(index, file_id, copies, registry)
+        if registry:
+            registry.register([triggers[0] for _, triggers in pending.values()], self.handle, file_id)
+            registry.report.embedded += len(pending) - len(copies)
+
+        index.create_snapshot()
         return ret
 
+    def check_copies(
+            self,
+            index: EmbeddingIndex,
+            file_id: str,
+            copies: Dict[str, List[float]],
+            registry: Optional[TriggerRegistry] = None
+    ):
+        """Check that each copied item kept its vector, since not every index honors a provided embedding."""
+        res = index.list_items(file_id=file_id)
+        stored = {item.id: item.embedding for item in res.items or []}
+        for embedding_id, vector in copies.items():
+            embedding = stored.get(embedding_id)
+            if not embedding:
+                raise SteamshipError(message=f"Index item {embedding_id} of intent {self.handle} has no embedding after embedding.")
+            if len(embedding) != len(vector) or any(abs(a - b) > 1e-6 for a, b in zip(embedding, vector)):
+                logging.warning(f"Index re-embedded copied item {embedding_id} of intent {self.handle}.")
+                if registry:
+                    registry.report.vectors_copied -= 1
+                    registry.report.embedded += 1
+
     @staticmethod
     def from_steamship_file(file: File) -> "OiIntent":
         responses = [OiResponse.from_steamship_block(block) for block in file.blocks or []]
@@ -309,12 +499,18 @@ class OiIntent(CamelModel):
             logging.info(f"Reloading intent file for {self.handle}: {self.file_id}")
             return File.get(client=client, _id=self.file_id)
 
-    def save(self, client: Steamship, index: EmbeddingIndex) -> "OiIntent":
+    def save(self, client: Steamship, index: EmbeddingIndex, registry: Optional[TriggerRegistry] = None) -> "OiIntent":
         # Create a file that contains the responses
         response_file = self.to_steamship_file(client)
 
         # Now add the triggers to the index, linking each item with the file
-        triggers = self.add_to_index(index, response_file.id)
+        owns_registry = registry is None
+        if owns_registry:
+            registry = TriggerRegistry(client, index)
+        triggers = self.add_to_index(index, response_file.id, registry)
+        if owns_registry:
+            self.report = registry.report
+            logging.info(f"Saved intent {self.handle}: {self.report}")
 
         self.file_id = response_file.id
         self.triggers = triggers
@@ -333,20 +529,45 @@ class OiFeed(CamelModel):
     # List of prompts in the feed
     prompts: Optional[List[GptPrompt]]
 
+    # Embedding index partition to learn the feed into. If None, the feed is partitioned by its handle.
+    partition: Optional[str] = None
+
+    # Trigger deduplication counts from the last save
+    report: Optional[OiIngestReport] = None
+
     def save(self, client: Steamship, index: EmbeddingIndex) -> "OiFeed":
         logging.info(f"Saving feed {self.handle} ")
+        registry = TriggerRegistry(client, index)
         if self.intents:
-            intents = [intent.save(client, index) for intent in self.intents or []]
+            # One lookup for the whole feed; each intent only looks up what is left.
+            registry.load([trigger.text for intent in self.intents for trigger in intent.triggers or [] if trigger.embedding_id is None])
+            intents = [intent.save(client, index, registry) for intent in self.intents or []]
             self.intents = intents
+        self.report = registry.report
+        logging.info(f"Saved feed {self.handle}: {self.report}")
         if self.prompts:
             prompts = [prompt.save(client) for prompt in self.prompts or []]
             self.prompts = prompts
 
         return self
 
+    @property
+    def partition_key(self) -> str:
+        """The partition name the feed is learned under and selected by."""
+        return self.partition or self.handle
+
 class OiQuestion(CamelModel):
     text: str
     context: Optional[List[str]]
 
+    # Partitions to search. If None, the shared index and every partition are searched.
+    partitions: Optional[List[str]] = None
+
+class OiMatch(CamelModel):
+    """The intent and response matched for a question, with the prompts needed to complete it."""
+    intent: Optional[OiIntent] = None
+    response: Optional[OiResponse] = None
+    prompts: Dict[str, GptPrompt] = {}
+
 class OiAnswer(CamelModel):
     top_response: Optional[OiResponse]
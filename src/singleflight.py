@@ -0,0 +1,176 @@
+"""Single-flight coalescing of identical concurrent calls."""
+import hashlib
+import json
+import threading
+import time
+import uuid
+from typing import Any, Callable, Dict, Hashable, Optional
+
+from steamship import Steamship, Tag
+from steamship.utils.kv_store import KeyValueStore
+
+# Identifies this process's counters among the workers sharing a workspace.
+PROCESS_ID = uuid.uuid4().hex
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class SingleFlight:
+    """Runs at most one in-flight call per key; concurrent callers with the same key wait and share its result.
+
+    A call that raises re-raises the same exception in every caller waiting on it. Nothing is cached once the
+    call finishes: the next caller with that key starts a new call. Calls are only coalesced within one process.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[Hashable, _Call] = {}
+        self.calls = 0
+        self.executions = 0
+        self.coalesced = 0
+
+    def do(self, key: Hashable, fn: Callable[[], Any]) -> Any:
+        with self._lock:
+            self.calls += 1
+            call = self._calls.get(key)
+            if call is not None:
+                self.coalesced += 1
+                leader = False
+            else:
+                call = _Call()
+                self._calls[key] = call
+                self.executions += 1
+                leader = True
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "executions": self.executions,
+                "coalesced": self.coalesced,
+                "inFlight": len(self._calls)
+            }
+
+
+class SharedFlight:
+    """Coalesces identical calls across every worker of a workspace, through short-lived shared results.
+
+    Within a process, concurrent callers share one call as with `SingleFlight`. The first result for a key is then
+    stored in a workspace `KeyValueStore` for the rest of its `ttl_seconds` window, and callers on any worker read it
+    there instead of calling again. A result can therefore be up to one window stale. The store has no
+    compare-and-set, so workers that miss at the same moment each call once.
+
+    Results live in two stores used in alternate windows; a worker's first write in a window clears the other one.
+    Counters are kept per workspace, and each worker periodically saves its own as one entry of a shared store,
+    so `stats` can sum them without any worker rewriting another's.
+    """
+
+    def __init__(self, name: str, ttl_seconds: int = 10, flush_seconds: int = 30):
+        self.name = name
+        self.ttl_seconds = ttl_seconds
+        self.flush_seconds = flush_seconds
+        self.local = SingleFlight()
+        self._lock = threading.Lock()
+        self._counts: Dict[str, Dict[str, int]] = {}
+        self._flushed_at: Dict[str, float] = {}
+        self._cleared: Dict[str, int] = {}
+
+    def _count(self, workspace_id: str, **counts: int):
+        with self._lock:
+            totals = self._counts.setdefault(workspace_id, {"calls": 0, "executions": 0, "coalesced": 0, "sharedHits": 0})
+            for name, count in counts.items():
+                totals[name] += count
+
+    def _results(self, client: Steamship, window: int) -> KeyValueStore:
+        return KeyValueStore(client, f"{self.name}-{window % 2}")
+
+    def _metrics(self, client: Steamship) -> KeyValueStore:
+        return KeyValueStore(client, f"{self.name}-metrics")
+
+    def do(
+            self,
+            client: Steamship,
+            key: Any,
+            fn: Callable[[], Any],
+            dump: Callable[[Any], Dict],
+            load: Callable[[Dict], Any]
+    ) -> Any:
+        """Return `fn()`, or a result shared for the same `key`, which must be JSON-serializable.
+
+        `dump` and `load` convert results to and from the dicts held in the store.
+        """
+        workspace_id = client.config.workspace_id
+        digest = hashlib.sha256(json.dumps([workspace_id, key]).encode("utf-8")).hexdigest()
+        led = []
+
+        def lead():
+            led.append(True)
+            window = int(time.time() // self.ttl_seconds)
+            store = self._results(client, window)
+            stored = store.get(digest)
+            if stored is not None and stored.get("window") == window:
+                self._count(workspace_id, coalesced=1, sharedHits=1)
+                return load(stored["result"])
+
+            result = fn()
+            self._count(workspace_id, executions=1)
+            with self._lock:
+                clear = self._cleared.get(workspace_id, -1) < window
+                self._cleared[workspace_id] = window
+            if clear:
+                self._results(client, window + 1).reset()
+            store.set(digest, {"window": window, "result": dump(result)})
+            return result
+
+        self._count(workspace_id, calls=1)
+        result = self.local.do((workspace_id, digest), lead)
+        if not led:
+            self._count(workspace_id, coalesced=1)
+
+        if time.monotonic() - self._flushed_at.get(workspace_id, 0) >= self.flush_seconds:
+            self.flush(client)
+        return result
+
+    def flush(self, client: Steamship):
+        """Save this worker's counters for the client's workspace to the shared store."""
+        workspace_id = client.config.workspace_id
+        with self._lock:
+            self._flushed_at[workspace_id] = time.monotonic()
+            counts = dict(self._counts.get(workspace_id) or {})
+        if counts:
+            self._metrics(client).set(PROCESS_ID, counts)
+
+    def stats(self, client: Steamship) -> Dict[str, int]:
+        """Sum the counters every worker has saved for the client's workspace, after saving this worker's."""
+        self.flush(client)
+        kind = self._metrics(client).store_identifier
+        totals = {"calls": 0, "executions": 0, "coalesced": 0, "sharedHits": 0, "workers": 0}
+        for tag in Tag.query(client, f'filetag and kind "{kind}"').tags or []:
+            if tag.name == "__init__" or not tag.value:
+                continue
+            totals["workers"] += 1
+            for name in ["calls", "executions", "coalesced", "sharedHits"]:
+                totals[name] += tag.value.get(name, 0)
+        return totals
@@ -0,0 +1,56 @@
+"""Benchmark cold-worker warm-up: the lazy remote path against a compiled bundle.
+
+Each round starts a fresh worker (a new `OiPackage`, with the process-wide bundle cache cleared) and times
+its first answer to each question, once per path. Requires a Steamship workspace; run it from the repository root:
+
+    python tests/benchmark_bundle_warmup.py --rounds 5
+"""
+import argparse
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).parent.parent
+sys.path[:0] = [str(ROOT), str(ROOT / "src")]
+
+from steamship import Steamship  # noqa: E402
+
+from api import BUNDLES, OiPackage  # noqa: E402
+from bundle import OiBundle, fetch_trigger_vectors  # noqa: E402
+from model import OiQuestion  # noqa: E402
+from tests.test_unit import TEST_FEED, random_name, testdata  # noqa: E402
+
+
+def first_answer_ms(client: Steamship, question: OiQuestion, config: dict) -> float:
+    """Time from worker start to the first answer, in milliseconds."""
+    BUNDLES.clear()
+    start = time.perf_counter()
+    oi = OiPackage(client=client, config=config)
+    oi.query(question=question)
+    return (time.perf_counter() - start) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    client = Steamship(workspace=random_name())
+    oi = OiPackage(client=client)
+    feed = oi.learn_feed(feed=TEST_FEED)
+    path = str(Path(tempfile.mkdtemp()) / "feed.oi")
+    OiBundle.write(path, feed, fetch_trigger_vectors(oi.index_for(feed.partition_key), feed))
+
+    print(f"{'question':40} {'path':8} {'median ms':>10} {'p90 ms':>10}")
+    for text, context, _ in testdata:
+        question = OiQuestion(text=text, context=context)
+        for name, config in [("lazy", {}), ("bundle", {"bundle_path": path})]:
+            times = sorted(first_answer_ms(client, question, config) for _ in range(args.rounds))
+            p90 = times[min(len(times) - 1, int(len(times) * 0.9))]
+            print(f"{text[:40]:40} {name:8} {statistics.median(times):10.1f} {p90:10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,20 @@
 """Unit tests for the package."""
 import logging
+import threading
+import time
+from array import array
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional
 
 import pytest
-from steamship import Steamship, PackageInstance
+from steamship import EmbeddingIndex, Steamship, PackageInstance
 
 from openai import complete
-from src.model import OiQuestion, OiFeed, OiIntent, OiTrigger, OiResponse, OiResponseType, GptPrompt
-from src.api import OiPackage
+from src.model import OiQuestion, OiFeed, OiIntent, OiTrigger, OiResponse, OiResponseType, GptPrompt, \
+    TriggerRegistry, normalize_trigger_text
+from src.api import OiPackage, QUERY_FLIGHTS, partition_index_handle
+from src.bundle import OiBundle, HEADER, ALIGNMENT
+from src.singleflight import SingleFlight
 import string
 import random
 
@@ -117,6 +124,7 @@ TEST_FEED = OiFeed(
 
 
 GLOBAL_OI: Optional[OiPackage] = None
+GLOBAL_FEED: Optional[OiFeed] = None
 
 
 def test_context_matching():
@@ -124,6 +132,117 @@ def test_context_matching():
     assert HOW_TO_GET_IN_OFFICE.responses[1] == HOW_TO_GET_IN_OFFICE.top_response(["#afterhours"])
 
 
+def test_bundle_roundtrip(tmp_path):
+    feed = OiFeed(
+        handle="bundle-feed",
+        intents=[
+            OiIntent(
+                handle="greeting",
+                file_id="file-1",
+                triggers=[OiTrigger(text="Hello there!", embedding_id="e1"), OiTrigger(text="hi", embedding_id="e2")],
+                responses=[OiResponse(text="Hi!", prompt_handle="pass-through")]
+            ),
+            OiIntent(
+                handle="goodbye",
+                file_id="file-2",
+                triggers=[OiTrigger(text="bye", embedding_id="e3")],
+                responses=[OiResponse(type=OiResponseType.SHUFFLE, text_options=["Bye", "Later"])]
+            )
+        ],
+        prompts=[PASS_THROUGH_PROMPT]
+    )
+    vectors = {"e1": [1.0, 0.0, 0.5], "e2": [0.0, 1.0, 0.5], "e3": [0.25, 0.25, 0.0]}
+    path = str(tmp_path / "feed.oi")
+    OiBundle.write(path, feed, vectors)
+
+    bundle = OiBundle.load(path)
+    assert bundle.handle == "bundle-feed"
+    assert bundle.dimensionality == 3
+    assert bundle.partition == "bundle-feed"
+    assert bundle.match_trigger("  Hello there ").handle == "greeting"
+    assert bundle.intent_for_file("file-2").responses[0].text_options == ["Bye", "Later"]
+    assert bundle.prompts["pass-through"].stop == "\n\n"
+
+    # The vector block follows the JSON section, one row per distinct trigger.
+    with open(path, "rb") as f:
+        data = f.read()
+    _, _, dimensionality, section_length, count = HEADER.unpack_from(data, 0)
+    offset = HEADER.size + section_length
+    offset += (ALIGNMENT - offset % ALIGNMENT) % ALIGNMENT
+    rows = array("f", data[offset:offset + count * dimensionality * 4])
+    assert count == 3
+    assert list(rows) == [1.0, 0.0, 0.5, 0.0, 1.0, 0.5, 0.25, 0.25, 0.0]
+
+
+def test_normalize_trigger_text():
+    assert normalize_trigger_text("What's for dinner?") == normalize_trigger_text("  what's FOR   dinner")
+    assert normalize_trigger_text("what's for dinner") != normalize_trigger_text("what's for lunch")
+    assert len({normalize_trigger_text(t) for t in ["C++", "C#", "C"]}) == 3
+    assert normalize_trigger_text(".NET") != normalize_trigger_text("NET")
+    assert normalize_trigger_text("?") != normalize_trigger_text("!!!")
+    assert normalize_trigger_text("C++?") == normalize_trigger_text("c++")
+
+
+def test_trigger_registry_resolve():
+    """An earlier version of the same intent is preferred over other intents, whatever the entry order."""
+    registry = TriggerRegistry(None, EmbeddingIndex(id="index-1"))
+    key = TriggerRegistry.key("What's for lunch?")
+    registry._found[key] = [
+        {"embeddingId": "e1", "intent": "lunch-menu", "fileId": "file-1", "indexId": "index-2"},
+        {"embeddingId": "e2", "intent": "whats-for-lunch", "fileId": "file-2", "indexId": "index-1"}
+    ]
+    registry._vectors[("index-2", "file-1")] = {"e1": [1.0]}
+    registry._vectors[("index-1", "file-2")] = {"e2": [2.0]}
+
+    assert registry.resolve(OiTrigger(text="what's for LUNCH"), "whats-for-lunch", "file-3") == (None, [2.0])
+    assert registry.report.duplicates_from_earlier_versions == 1
+    assert registry.resolve(OiTrigger(text="What's for lunch"), "whats-for-lunch", "file-2") == ("e2", None)
+    assert registry.report.duplicates_within_intent == 1
+    assert registry.report.vectors_copied == 1
+
+
+def test_single_flight():
+    flights = SingleFlight()
+    release = threading.Event()
+    executions = []
+
+    def search():
+        executions.append(1)
+        release.wait(5)
+        return "result"
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        futures = [executor.submit(flights.do, "how do i rebase", search) for _ in range(8)]
+        while flights.stats()["calls"] < 8:
+            time.sleep(0.01)
+        release.set()
+        results = [f.result() for f in futures]
+
+    assert results == ["result"] * 8
+    assert len(executions) == 1
+    assert flights.stats() == {"calls": 8, "executions": 1, "coalesced": 7, "inFlight": 0}
+
+    # Once finished, the next call runs again rather than reusing a cached result.
+    assert flights.do("how do i rebase", lambda: "again") == "again"
+
+
+def test_single_flight_error():
+    flights = SingleFlight()
+
+    def fail():
+        raise ValueError("search failed")
+
+    with pytest.raises(ValueError):
+        flights.do("key", fail)
+    assert flights.stats()["inFlight"] == 0
+
+
+def test_partition_index_handle():
+    handles = {partition_index_handle(p) for p in ["Office B", "office_b", "office-b", "#office-b"]}
+    assert len(handles) == 4
+    assert partition_index_handle("office-b") == partition_index_handle("office-b")
+
+
 def test_context_shuffle():
     values = set()
     for i in range(10):
@@ -136,12 +255,13 @@ def test_context_shuffle():
 
 @pytest.fixture
 def oi():
-    global GLOBAL_OI
+    global GLOBAL_OI, GLOBAL_FEED
     if GLOBAL_OI:
         return GLOBAL_OI
     client = Steamship(workspace=random_name())
     GLOBAL_OI = OiPackage(client=client)
     resp = GLOBAL_OI.learn_feed(feed=TEST_FEED)
+    GLOBAL_FEED = resp
     assert isinstance(resp, OiFeed)
     assert len(resp.intents) == 4
     for intent in resp.intents:
@@ -171,6 +291,126 @@ def test_response(oi: OiPackage, question, context, expected):
     assert a.top_response.text is not None
     assert a.top_response.text == expected
 
+def test_partitioned_query(oi: OiPackage):
+    """Feeds are only searched when their partition is selected, or when no selector is given.
+
+    A feed declaring no partition is selected by its handle.
+    """
+    other_feed = OiFeed(
+        handle="other-feed",
+        partition="#office-b",
+        intents=[
+            OiIntent(
+                handle="how-to-get-in-office-b",
+                triggers=[OiTrigger(text="how do i get into building b")],
+                responses=[OiResponse(text="Badge in at the side entrance")]
+            )
+        ]
+    )
+    oi.learn_feed(feed=other_feed)
+
+    a = oi.query(question=OiQuestion(text="How do I get into building B?", partitions=["#office-b"]))
+    assert a.top_response.text == "Badge in at the side entrance"
+
+    a = oi.query(question=OiQuestion(text="How do I get into building B?"))
+    assert a.top_response.text == "Badge in at the side entrance"
+
+    a = oi.query(question=OiQuestion(text="How do I rebase?", partitions=["#office-b"]))
+    assert a.top_response.text == "Badge in at the side entrance"
+
+    a = oi.query(question=OiQuestion(text="How do I rebase?"))
+    assert a.top_response.text == HOW_TO_REBASE.responses[0].text
+
+    a = oi.query(question=OiQuestion(text="How do I rebase?", partitions=[TEST_FEED.handle]))
+    assert a.top_response.text == HOW_TO_REBASE.responses[0].text
+
+    a = oi.query(question=OiQuestion(text="How do I get into building B?", partitions=[TEST_FEED.handle]))
+    assert a.top_response.text != "Badge in at the side entrance"
+
+    a = oi.query(question=OiQuestion(text="How do I rebase?", partitions=["no-such-partition"]))
+    assert a.top_response is None
+
+    # A feed learned before partitioning keeps its triggers in the shared index, and is still selectable.
+    legacy = oi.learn_intent(intent=OiIntent(
+        handle="how-to-park",
+        triggers=[OiTrigger(text="where do i park my car")],
+        responses=[OiResponse(text="Level 2 of the garage")]
+    ))
+    oi.learn_feed(feed=OiFeed(handle="legacy-feed", intents=[legacy]))
+    a = oi.query(question=OiQuestion(text="Where can I park?", partitions=["legacy-feed"]))
+    assert a.top_response.text == "Level 2 of the garage"
+
+
+def test_trigger_dedup(oi: OiPackage):
+    """Normalized-identical triggers are embedded once, within and across feeds."""
+    feed = OiFeed(
+        handle="dedup-feed",
+        intents=[
+            OiIntent(
+                handle="whats-for-lunch",
+                triggers=[
+                    OiTrigger(text="What's for lunch?"),
+                    OiTrigger(text="what's for LUNCH"),
+                    OiTrigger(text="What's for dinner?")
+                ],
+                responses=[OiResponse(text="Salad")]
+            )
+        ]
+    )
+    resp = oi.learn_feed(feed=feed)
+    assert resp.report.embedded == 1
+    assert resp.report.duplicates_within_intent == 1
+    assert resp.report.duplicates_across_feeds == 1
+    assert resp.report.vectors_copied == 1
+
+    # A duplicate within the intent shares its item; one from another intent gets its own item for this intent.
+    lunch, lunch_again, dinner = resp.intents[0].triggers
+    assert lunch.embedding_id == lunch_again.embedding_id
+    assert dinner.embedding_id != GLOBAL_FEED.intents[2].triggers[0].embedding_id
+
+    # The copied item is stored with its vector, and the trigger now also resolves to this feed's intent.
+    items = oi.index_for(feed.handle).list_items(file_id=resp.intents[0].file_id).items
+    copied = [item for item in items if item.id == dinner.embedding_id]
+    assert len(copied) == 1
+    assert copied[0].embedding
+    a = oi.query(question=OiQuestion(text="What's for dinner?", partitions=[feed.handle]))
+    assert a.top_response.text == "Salad"
+
+    intent = oi.learn_intent(intent=OiIntent(
+        handle="lunch-menu",
+        triggers=[OiTrigger(text="WHAT'S FOR LUNCH")],
+        responses=[OiResponse(text="Soup")]
+    ))
+    assert intent.report.embedded == 0
+    assert intent.report.duplicates_across_feeds == 1
+
+
+def test_metrics(oi: OiPackage, monkeypatch):
+    """Concurrent queries for the same normalized question run one match between them."""
+    n = 4
+    text = f"How do I rebase {random_name()}?"
+    before = oi.metrics()
+    match = oi.match
+
+    def slow_match(question, bundle=None):
+        # Hold the leader until every caller has joined its flight.
+        deadline = time.monotonic() + 30
+        while QUERY_FLIGHTS.local.stats()["calls"] < before["worker"]["calls"] + n and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return match(question, bundle)
+
+    monkeypatch.setattr(oi, "match", slow_match)
+    questions = [OiQuestion(text=text), OiQuestion(text=f"  {text.upper()}")] * (n // 2)
+    with ThreadPoolExecutor(max_workers=n) as executor:
+        answers = list(executor.map(lambda q: oi.query(question=q), questions))
+
+    after = oi.metrics()
+    assert len({answer.top_response.text for answer in answers}) == 1
+    assert after["queries"]["calls"] == before["queries"]["calls"] + n
+    assert after["queries"]["executions"] == before["queries"]["executions"] + 1
+    assert after["queries"]["coalesced"] == before["queries"]["coalesced"] + n - 1
+
+
 def test_gpt(oi: OiPackage):
     """You can test your app like a regular Python object."""
     a = oi.query(question=OiQuestion(text="Tell me something about France"))